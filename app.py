@@ -1,10 +1,20 @@
+import asyncio
+import bisect
+import hashlib
+import threading
+import time
 import streamlit as st
 import google.generativeai as genai
+import diskcache_rs
 import re
+import tenacity
+from collections import deque
+from google.api_core import exceptions as api_exceptions
 from typing import Optional, List, Dict
 from dataclasses import dataclass
 from enum import Enum
 import logging
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from youtube_transcript_api import YouTubeTranscriptApi
 
 # 로깅 설정
@@ -17,8 +27,25 @@ class SummaryMode(Enum):
     TIMELINE = "타임라인 요약"
     KEYWORDS = "키워드 요약"
 
-CHUNK_SIZE = 4000
+CHUNK_SIZE = 500_000  # 약 12.5만 토큰, gemini-1.5-pro의 1M 토큰 한도에 여유 있게 수용
 MAX_RETRIES = 3
+MAX_CONCURRENT_REQUESTS = 4  # Gemini RPM 제한을 고려한 동시 요청 수
+REQUESTS_PER_MINUTE = 60  # 현재 Gemini 쿼터에 맞춘 분당 요청 예산
+CACHE_TTL_SECONDS = 86400
+
+# 일시적 오류(쿼터 초과, 서비스 불가, 타임아웃)만 재시도 대상
+_RETRYABLE_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+)
+
+# 같은 영상/프롬프트를 다시 요청할 때 네트워크 호출을 생략하기 위한 디스크 캐시
+cache = diskcache_rs.Cache("./.cache")
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_SENTENCE_END_RE = re.compile(r"\.(?=\s|$)")
+_VIDEO_ID_RE = re.compile(r"(?:v=|youtu\.be/|/embed/|/shorts/)([0-9A-Za-z_-]{11})")
 
 @dataclass
 class TranscriptEntry:
@@ -31,23 +58,30 @@ class TranscriptFetcher:
         self.status = st.empty()
         
     def fetch(self, video_id: str) -> Optional[List[TranscriptEntry]]:
+        cached = cache.get(f"tr:{video_id}")
+        if cached is not None:
+            return cached
         try:
             self.status.info("1. 자막 목록을 확인하는 중...")
             transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
-            
+
             self.available_langs = [t.language_code for t in transcript_list]
             self.status.info(f"2. 사용 가능한 자막: {self.available_langs}")
-            
+
             # 한국어 자막 우선
             if 'ko' in self.available_langs:
-                return self._fetch_transcript(transcript_list, 'ko')
+                transcript = self._fetch_transcript(transcript_list, 'ko')
             # 영어 자막 fallback
             elif 'en' in self.available_langs:
-                return self._fetch_transcript(transcript_list, 'en')
-                
-            self.status.info("3. 지원하는 언어의 자막을 찾을 수 없습니다.")
-            return None
-            
+                transcript = self._fetch_transcript(transcript_list, 'en')
+            else:
+                self.status.info("3. 지원하는 언어의 자막을 찾을 수 없습니다.")
+                return None
+
+            if transcript:
+                cache.set(f"tr:{video_id}", transcript, expire=CACHE_TTL_SECONDS)
+            return transcript
+
         except Exception as e:
             logger.error(f"자막 가져오기 실패: {str(e)}")
             self.status.error(f"오류 발생: {str(e)}")
@@ -77,87 +111,182 @@ class TranscriptFormatter:
 class TranscriptChunker:
     @staticmethod
     def chunk_text(text: str, max_length: int = CHUNK_SIZE) -> List[str]:
+        # 문장 경계를 한 번에 찾아두고 인덱스만 옮겨가며 자르기 (구간당 복사 1회)
+        sentence_ends = [m.end() for m in _SENTENCE_END_RE.finditer(text)]
         chunks = []
-        while len(text) > max_length:
-            split_index = text.rfind('.', 0, max_length)
-            if split_index == -1:
-                split_index = max_length
-            chunks.append(text[:split_index].strip())
-            text = text[split_index:].strip()
-        chunks.append(text)
+        start = 0
+        while len(text) - start > max_length:
+            # start+max_length 이내의 마지막 문장 경계를 이분 탐색
+            idx = bisect.bisect_right(sentence_ends, start + max_length) - 1
+            if idx >= 0 and sentence_ends[idx] > start:
+                end = sentence_ends[idx]
+            else:
+                end = start + max_length
+            chunks.append(text[start:end].strip())
+            start = end
+        chunks.append(text[start:].strip())
         return chunks
 
+# 모드별 고정 지시문. 매 프롬프트에 붙이는 대신 system_instruction으로 보내
+# Gemini가 프리픽스를 재토큰화하지 않고 캐시를 활용할 수 있게 한다
+PROMPT_PREFIX = {
+    SummaryMode.KEY_POINTS: (
+        "다음은 유튜브 영상의 자막입니다. 자막 언어와 무관하게 내용을 **한국어**로 간단히 요약해줘.\n"
+        "중요한 핵심 내용만 **3~5문장**으로 정리해줘."
+    ),
+    SummaryMode.TIMELINE: (
+        "다음 유튜브 자막을 보고 **시간 흐름 순서에 따라** 내용을 정리해줘.\n"
+        "자막 언어와 상관없이 **한국어**로 정리하고, **타임스탬프 기준으로 구간별 요점**을 알려줘.\n\n"
+        "형식:\n"
+        "- 00:00~02:30: 내용 요약"
+    ),
+    SummaryMode.KEYWORDS: (
+        "다음 자막에서 중요한 **핵심 키워드** 5~10개를 추출해줘.\n"
+        "각 키워드마다 **간단한 설명**을 붙이고, 자막 언어와 관계없이 반드시 **한국어**로 출력해줘.\n\n"
+        "형식:\n"
+        "- 키워드: 설명"
+    ),
+}
+
+@st.cache_resource
+def get_gemini_model(system_instruction: Optional[str] = None) -> genai.GenerativeModel:
+    # 모델(과 내부 연결)을 세션 간에 재사용해 매 요청마다의 핸드셰이크 비용 제거
+    return genai.GenerativeModel("gemini-1.5-pro", system_instruction=system_instruction)
+
+@st.cache_resource
+def get_event_loop():
+    # Gemini 비동기 클라이언트의 grpc 채널은 생성된 루프에 바인딩되므로,
+    # 클릭마다 asyncio.run으로 루프를 만들고 닫으면 두 번째 클릭부터
+    # 'Event loop is closed'로 실패한다. 전용 스레드에서 도는 루프 하나를
+    # 프로세스 수명 동안 재사용한다
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return loop, thread
+
+def run_async(coro):
+    loop, thread = get_event_loop()
+    # 루프 스레드에 현재 ScriptRunContext를 붙여 상태 메시지가 화면에 그려지게 한다
+    add_script_run_ctx(thread, get_script_run_ctx())
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+@st.cache_resource
+def warmup_gemini_channel() -> bool:
+    # 요약이 실제로 쓰는 비동기 클라이언트의 채널을 같은 전용 루프에서 미리 연다.
+    # 채널은 루프와 함께 프로세스 수명 동안 유지되므로 워밍업은 한 번이면 충분하다
+    model = get_gemini_model()
+
+    async def ping() -> None:
+        try:
+            # 1토큰짜리 요청으로 TLS/gRPC 채널만 미리 열어 둔다
+            await model.generate_content_async("ping", generation_config={"max_output_tokens": 1})
+        except Exception as e:
+            logger.warning(f"Gemini 워밍업 실패 (요약 시 재시도): {str(e)}")
+
+    loop, _ = get_event_loop()
+    # 자막 다운로드와 겹치도록 결과는 기다리지 않는다
+    asyncio.run_coroutine_threadsafe(ping(), loop)
+    return True
+
+class RateLimiter:
+    """최근 호출 시각을 슬라이딩 윈도로 추적해 분당 요청 예산을 지킨다."""
+
+    def __init__(self, requests_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.timestamps = deque()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self.timestamps and now - self.timestamps[0] >= 60:
+                self.timestamps.popleft()
+            if len(self.timestamps) < self.requests_per_minute:
+                self.timestamps.append(now)
+                return
+            # 가장 오래된 호출이 윈도를 벗어날 때까지 대기
+            await asyncio.sleep(60 - (now - self.timestamps[0]))
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE)
+
 class SummaryGenerator:
     def __init__(self):
-        self.model = genai.GenerativeModel("gemini-1.5-pro")
         self.status = st.empty()
-        
-    def build_prompt(self, transcript: str, mode: SummaryMode) -> str:
-        prompts = {
-            SummaryMode.KEY_POINTS: """
-다음은 유튜브 영상의 자막입니다. 자막 언어와 무관하게 내용을 **한국어**로 간단히 요약해줘.
-중요한 핵심 내용만 **3~5문장**으로 정리해줘.
-
-자막:
-{transcript}
-""",
-            SummaryMode.TIMELINE: """
-다음 유튜브 자막을 보고 **시간 흐름 순서에 따라** 내용을 정리해줘.
-자막 언어와 상관없이 **한국어**로 정리하고, **타임스탬프 기준으로 구간별 요점**을 알려줘.
-
-형식:
-- 00:00~02:30: 내용 요약
-
-자막:
-{transcript}
-""",
-            SummaryMode.KEYWORDS: """
-다음 자막에서 중요한 **핵심 키워드** 5~10개를 추출해줘.
-각 키워드마다 **간단한 설명**을 붙이고, 자막 언어와 관계없이 반드시 **한국어**로 출력해줘.
-
-형식:
-- 키워드: 설명
-
-자막:
-{transcript}
-"""
-        }
-        return prompts[mode].format(transcript=transcript)
-        
-    def generate_summary(self, prompt: str) -> str:
+        # Gemini RPM 제한을 넘지 않도록 동시 요청 수 제한
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    def build_prompt(self, transcript: str) -> str:
+        # 고정 지시문은 모드별 모델의 system_instruction에 있으므로 자막만 보낸다
+        return f"자막:\n{transcript}"
+
+    async def generate_summary(self, mode: SummaryMode, prompt: str, placeholder=None) -> str:
+        # 공백만 다른 프롬프트가 같은 키를 갖도록 정규화한 뒤 해시를 키로 사용.
+        # 지시문이 system_instruction으로 빠졌으므로 모드도 키에 포함해야 한다
+        key = f"gm:{mode.name}:" + hashlib.sha256(_WHITESPACE_RE.sub(" ", prompt).strip().encode()).hexdigest()
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
         try:
-            response = self.model.generate_content(prompt)
-            return response.text
+            model = get_gemini_model(PROMPT_PREFIX[mode])
+            text = await self._generate_with_retry(model, prompt, placeholder)
         except Exception as e:
             logger.error(f"요약 생성 실패: {str(e)}")
             raise
-            
-    def summarize_in_chunks(self, transcript: str, mode: SummaryMode) -> str:
+        cache.set(key, text, expire=CACHE_TTL_SECONDS)
+        return text
+
+    @tenacity.retry(
+        stop=tenacity.stop_after_attempt(MAX_RETRIES),
+        wait=tenacity.wait_exponential_jitter(initial=1, max=30),
+        retry=tenacity.retry_if_exception_type(_RETRYABLE_ERRORS),
+        reraise=True,
+    )
+    async def _generate_with_retry(self, model: genai.GenerativeModel, prompt: str, placeholder=None) -> str:
+        async with self.semaphore:
+            await rate_limiter.acquire()
+            # 스트리밍으로 받아 전체 디코딩을 기다리지 않고 부분 결과를 먼저 표시
+            response = await model.generate_content_async(prompt, stream=True)
+            parts = []
+            async for part in response:
+                parts.append(part.text)
+                if placeholder is not None:
+                    placeholder.write("".join(parts))
+        return "".join(parts)
+
+    async def summarize_in_chunks(self, transcript: str, mode: SummaryMode) -> str:
         chunks = TranscriptChunker.chunk_text(transcript)
-        summaries = []
-        
-        self.status.info(f"[{mode.value}] 자막을 {len(chunks)}개 구간으로 나누었습니다.")
-        
-        for i, chunk in enumerate(chunks):
-            self.status.info(f"[{mode.value}] 자막을 분석하는 중... ({i+1}/{len(chunks)})")
-            prompt = self.build_prompt(chunk, mode)
-            summary = self.generate_summary(prompt)
-            summaries.append(summary)
-            self.status.info(f"[{mode.value}] {i+1}번째 구간 분석 완료!")
-            
+
+        # 대부분의 자막은 한 구간에 들어가므로 통합(reduce) 호출 없이 바로 요약
+        if len(chunks) == 1:
+            self.status.info(f"[{mode.value}] 자막을 분석하는 중...")
+            placeholder = st.empty()
+            final_summary = await self.generate_summary(mode, self.build_prompt(chunks[0]), placeholder)
+            placeholder.empty()  # 최종 결과는 아래에서 다시 출력
+            self.status.info(f"[{mode.value}] 요약 생성 완료!")
+            return final_summary
+
+        self.status.info(f"[{mode.value}] 자막을 {len(chunks)}개 구간으로 나누어 분석하는 중...")
+
+        # 구간별 요약은 서로 독립이므로 동시에 요청
+        tasks = [self.generate_summary(mode, self.build_prompt(chunk))
+                 for chunk in chunks]
+        summaries = await asyncio.gather(*tasks)
+
         self.status.info(f"[{mode.value}] 최종 요약을 생성하는 중...")
-        final_prompt = f"다음은 영상 요약 조각들입니다. 이들을 하나의 요약으로 통합해줘.\n\n{'\n'.join(summaries)}"
-        final_summary = self.generate_summary(final_prompt)
+        joined_summaries = "\n".join(summaries)
+        final_prompt = f"다음은 영상 요약 조각들입니다. 이들을 하나의 요약으로 통합해줘.\n\n{joined_summaries}"
+        placeholder = st.empty()
+        final_summary = await self.generate_summary(mode, final_prompt, placeholder)
+        placeholder.empty()  # 최종 결과는 아래에서 다시 출력
         self.status.info(f"[{mode.value}] 최종 요약 생성 완료!")
-        
+
         return final_summary
 
 def format_seconds(seconds: float) -> str:
-    m, s = divmod(int(seconds), 60)
-    return f"{m:02}:{s:02}"
+    s = int(seconds)
+    return f"{s // 60:02d}:{s % 60:02d}"
 
 def extract_video_id(url: str) -> Optional[str]:
-    match = re.search(r"(?:v=|\/)([0-9A-Za-z_-]{11}).*", url)
+    match = _VIDEO_ID_RE.search(url)
     return match.group(1) if match else None
 
 def main():
@@ -180,8 +309,10 @@ def main():
             st.error("유효한 유튜브 링크를 입력해주세요.")
             return
 
-        # 자막 가져오기
+        # 자막 다운로드와 Gemini 채널 워밍업은 서로 독립이므로 동시에 수행.
+        # 진행 메시지를 그리는 자막 다운로드는 메인 스레드에 남는다
         fetcher = TranscriptFetcher()
+        warmup_gemini_channel()
         transcript_data = fetcher.fetch(video_id)
 
         if not transcript_data:
@@ -193,20 +324,28 @@ def main():
         generator = SummaryGenerator()
         summaries_output = {}
 
-        for mode_str in selected_modes:
-            mode = SummaryMode(mode_str)
+        # 모드마다 같은 문자열을 다시 만들지 않도록 포맷팅은 한 번만 수행
+        plain_transcript = formatter.format_plain(transcript_data)
+        timed_transcript = formatter.format_with_timestamps(transcript_data)
+
+        async def summarize_mode(mode: SummaryMode) -> None:
             try:
-                formatted_transcript = (formatter.format_with_timestamps(transcript_data) 
-                                     if mode == SummaryMode.TIMELINE 
-                                     else formatter.format_plain(transcript_data))
-                
-                summary = generator.summarize_in_chunks(formatted_transcript, mode)
-                summaries_output[mode] = summary
-                
+                formatted_transcript = (timed_transcript
+                                     if mode == SummaryMode.TIMELINE
+                                     else plain_transcript)
+
+                summaries_output[mode] = await generator.summarize_in_chunks(formatted_transcript, mode)
+
             except Exception as e:
                 st.error(f"[{mode.value}] 요약 생성에 실패했습니다. 다시 시도해주세요.")
                 logger.exception(e)
-                continue
+
+        # 모드별 요약은 서로 독립이므로 동시에 실행
+        async def run_summaries() -> None:
+            await asyncio.gather(*(summarize_mode(SummaryMode(mode_str))
+                                   for mode_str in selected_modes))
+
+        run_async(run_summaries())
 
         # 결과 출력
         st.success("요약 완료!")
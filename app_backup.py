@@ -1,106 +1,259 @@
+import asyncio
+import bisect
+import hashlib
+import threading
+import time
 import streamlit as st
 from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound
 import google.generativeai as genai
+import diskcache_rs
 import re
+import requests
+import tenacity
+from collections import deque
+from google.api_core import exceptions as api_exceptions
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from typing import Optional
 
+# Gemini RPM 제한을 고려한 동시 요청 수
+MAX_CONCURRENT_REQUESTS = 4
+MAX_RETRIES = 3
+REQUESTS_PER_MINUTE = 60  # 현재 Gemini 쿼터에 맞춘 분당 요청 예산
+
+# 일시적 오류(쿼터 초과, 서비스 불가, 타임아웃)만 재시도 대상
+_RETRYABLE_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+)
+
+# 약 12.5만 토큰, gemini-1.5-pro의 1M 토큰 한도에 여유 있게 수용
+CHUNK_SIZE = 500_000
+
+# 같은 영상/프롬프트를 다시 요청할 때 네트워크 호출을 생략하기 위한 디스크 캐시
+CACHE_TTL_SECONDS = 86400
+cache = diskcache_rs.Cache("./.cache")
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_SENTENCE_END_RE = re.compile(r"\.(?=\s|$)")
+_VIDEO_ID_RE = re.compile(r"(?:v=|youtu\.be/|/embed/|/shorts/)([0-9A-Za-z_-]{11})")
+
 # Gemini API 키 설정 (Streamlit Cloud에서는 secrets.toml 이용)
 genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
 
+# 프록시는 선택 사항: secrets에 PROXY_LIST가 있으면 라운드 로빈으로 사용하고,
+# 비어 있으면 직접 연결한다
+proxy_pool: deque = deque(st.secrets.get("PROXY_LIST", []))
+
+def _next_proxy() -> Optional[str]:
+    if not proxy_pool:
+        return None
+    proxy_url = proxy_pool[0]
+    proxy_pool.rotate(-1)
+    return proxy_url
+
 # -----------------------------
 # Helper Functions
 # -----------------------------
 
 def extract_video_id(url: str) -> Optional[str]:
-    match = re.search(r"(?:v=|\/)([0-9A-Za-z_-]{11}).*", url)
+    match = _VIDEO_ID_RE.search(url)
     return match.group(1) if match else None
 
 def format_seconds(seconds: float) -> str:
-    m, s = divmod(int(seconds), 60)
-    return f"{m:02}:{s:02}"
+    s = int(seconds)
+    return f"{s // 60:02d}:{s % 60:02d}"
 
 def get_best_transcript(video_id: str) -> Optional[list[dict]]:
+    cached = cache.get(f"tr:{video_id}")
+    if cached is not None:
+        return cached
     try:
-        # 직접 자막 가져오기 시도
-        try:
-            return YouTubeTranscriptApi.get_transcript(video_id, languages=['ko'])
-        except:
+        for _ in range(max(1, len(proxy_pool))):
+            proxy_url = _next_proxy()
+            proxies = {"https": proxy_url} if proxy_url else None
+            # 직접 자막 가져오기 시도
             try:
-                return YouTubeTranscriptApi.get_transcript(video_id, languages=['en'])
+                transcript = YouTubeTranscriptApi.get_transcript(video_id, languages=['ko'], proxies=proxies)
+            except requests.exceptions.ProxyError:
+                # 응답하지 않는 프록시는 풀에서 제거하고 다음 프록시로 재시도
+                if proxy_url in proxy_pool:
+                    proxy_pool.remove(proxy_url)
+                continue
             except:
-                return None
+                try:
+                    transcript = YouTubeTranscriptApi.get_transcript(video_id, languages=['en'], proxies=proxies)
+                except requests.exceptions.ProxyError:
+                    # en 폴백 중에 죽은 프록시도 동일하게 제거하고 재시도
+                    if proxy_url in proxy_pool:
+                        proxy_pool.remove(proxy_url)
+                    continue
+                except:
+                    return None
+            cache.set(f"tr:{video_id}", transcript, expire=CACHE_TTL_SECONDS)
+            return transcript
+        return None
     except Exception as e:
         st.error("자막을 가져오는데 실패했습니다.")
         return None
 
 def format_transcript_with_timestamps(transcript: list[dict]) -> str:
-    formatted = ""
-    for entry in transcript:
-        start_time = format_seconds(entry['start'])
-        formatted += f"[{start_time}] {entry['text']}\n"
-    return formatted
+    # 문자열 += 누적은 O(N^2)로 퇴화할 수 있으므로 join으로 한 번에 생성
+    return "\n".join(f"[{format_seconds(entry['start'])}] {entry['text']}"
+                     for entry in transcript) + "\n"
 
-def chunk_text(text: str, max_length: int = 4000) -> list[str]:
+def chunk_text(text: str, max_length: int = CHUNK_SIZE) -> list[str]:
+    # 문장 경계를 한 번에 찾아두고 인덱스만 옮겨가며 자르기 (구간당 복사 1회)
+    sentence_ends = [m.end() for m in _SENTENCE_END_RE.finditer(text)]
     chunks = []
-    while len(text) > max_length:
-        split_index = text.rfind('.', 0, max_length)
-        if split_index == -1:
-            split_index = max_length
-        chunks.append(text[:split_index].strip())
-        text = text[split_index:].strip()
-    chunks.append(text)
+    start = 0
+    while len(text) - start > max_length:
+        # start+max_length 이내의 마지막 문장 경계를 이분 탐색
+        idx = bisect.bisect_right(sentence_ends, start + max_length) - 1
+        if idx >= 0 and sentence_ends[idx] > start:
+            end = sentence_ends[idx]
+        else:
+            end = start + max_length
+        chunks.append(text[start:end].strip())
+        start = end
+    chunks.append(text[start:].strip())
     return chunks
 
-def build_prompt(transcript: str, mode: str) -> str:
-    if mode == "핵심 요약":
-        return f"""
-다음은 유튜브 영상의 자막입니다. 자막 언어와 무관하게 내용을 **한국어**로 간단히 요약해줘.
-중요한 핵심 내용만 **3~5문장**으로 정리해줘.
-
-자막:
-{transcript}
-"""
-    elif mode == "타임라인 요약":
-        return f"""
-다음 유튜브 자막을 보고 **시간 흐름 순서에 따라** 내용을 정리해줘.
-자막 언어와 상관없이 **한국어**로 정리하고, **타임스탬프 기준으로 구간별 요점**을 알려줘.
-
-형식:
-- 00:00~02:30: 내용 요약
-
-자막:
-{transcript}
-"""
-    elif mode == "키워드 요약":
-        return f"""
-다음 자막에서 중요한 **핵심 키워드** 5~10개를 추출해줘.
-각 키워드마다 **간단한 설명**을 붙이고, 자막 언어와 관계없이 반드시 **한국어**로 출력해줘.
-
-형식:
-- 키워드: 설명
-
-자막:
-{transcript}
-"""
-    else:
-        return transcript
+# 모드별 고정 지시문. 매 프롬프트에 붙이는 대신 system_instruction으로 보내
+# Gemini가 프리픽스를 재토큰화하지 않고 캐시를 활용할 수 있게 한다
+PROMPT_PREFIX = {
+    "핵심 요약": (
+        "다음은 유튜브 영상의 자막입니다. 자막 언어와 무관하게 내용을 **한국어**로 간단히 요약해줘.\n"
+        "중요한 핵심 내용만 **3~5문장**으로 정리해줘."
+    ),
+    "타임라인 요약": (
+        "다음 유튜브 자막을 보고 **시간 흐름 순서에 따라** 내용을 정리해줘.\n"
+        "자막 언어와 상관없이 **한국어**로 정리하고, **타임스탬프 기준으로 구간별 요점**을 알려줘.\n\n"
+        "형식:\n"
+        "- 00:00~02:30: 내용 요약"
+    ),
+    "키워드 요약": (
+        "다음 자막에서 중요한 **핵심 키워드** 5~10개를 추출해줘.\n"
+        "각 키워드마다 **간단한 설명**을 붙이고, 자막 언어와 관계없이 반드시 **한국어**로 출력해줘.\n\n"
+        "형식:\n"
+        "- 키워드: 설명"
+    ),
+}
+
+def build_prompt(transcript: str) -> str:
+    # 고정 지시문은 모드별 모델의 system_instruction에 있으므로 자막만 보낸다
+    return f"자막:\n{transcript}"
+
+@st.cache_resource
+def get_gemini_model(system_instruction: Optional[str] = None) -> genai.GenerativeModel:
+    # 모델(과 내부 연결)을 세션 간에 재사용해 매 요청마다의 핸드셰이크 비용 제거
+    return genai.GenerativeModel("gemini-1.5-pro", system_instruction=system_instruction)
 
-def summarize_with_gemini(prompt: str) -> str:
-    model = genai.GenerativeModel("gemini-1.5-pro")
-    response = model.generate_content(prompt)
-    return response.text
+@st.cache_resource
+def get_event_loop():
+    # Gemini 비동기 클라이언트의 grpc 채널은 생성된 루프에 바인딩되므로,
+    # 클릭마다 asyncio.run으로 루프를 만들고 닫으면 두 번째 클릭부터
+    # 'Event loop is closed'로 실패한다. 전용 스레드에서 도는 루프 하나를
+    # 프로세스 수명 동안 재사용한다
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return loop, thread
 
-def summarize_in_chunks(transcript: str, mode: str, status_container) -> str:
+def run_async(coro):
+    loop, thread = get_event_loop()
+    # 루프 스레드에 현재 ScriptRunContext를 붙여 상태 메시지가 화면에 그려지게 한다
+    add_script_run_ctx(thread, get_script_run_ctx())
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+@st.cache_resource
+def warmup_gemini_channel() -> bool:
+    # 요약이 실제로 쓰는 비동기 클라이언트의 채널을 같은 전용 루프에서 미리 연다.
+    # 채널은 루프와 함께 프로세스 수명 동안 유지되므로 워밍업은 한 번이면 충분하다
+    model = get_gemini_model()
+
+    async def ping() -> None:
+        try:
+            # 1토큰짜리 요청으로 TLS/gRPC 채널만 미리 열어 둔다
+            await model.generate_content_async("ping", generation_config={"max_output_tokens": 1})
+        except Exception:
+            pass  # 워밍업 실패는 치명적이지 않음: 요약 시 다시 연결
+
+    loop, _ = get_event_loop()
+    # 자막 다운로드와 겹치도록 결과는 기다리지 않는다
+    asyncio.run_coroutine_threadsafe(ping(), loop)
+    return True
+
+class RateLimiter:
+    """최근 호출 시각을 슬라이딩 윈도로 추적해 분당 요청 예산을 지킨다."""
+
+    def __init__(self, requests_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.timestamps = deque()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self.timestamps and now - self.timestamps[0] >= 60:
+                self.timestamps.popleft()
+            if len(self.timestamps) < self.requests_per_minute:
+                self.timestamps.append(now)
+                return
+            # 가장 오래된 호출이 윈도를 벗어날 때까지 대기
+            await asyncio.sleep(60 - (now - self.timestamps[0]))
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE)
+
+@tenacity.retry(
+    stop=tenacity.stop_after_attempt(MAX_RETRIES),
+    wait=tenacity.wait_exponential_jitter(initial=1, max=30),
+    retry=tenacity.retry_if_exception_type(_RETRYABLE_ERRORS),
+    reraise=True,
+)
+async def _generate_with_retry(model, prompt: str, semaphore: asyncio.Semaphore, placeholder=None) -> str:
+    async with semaphore:
+        await rate_limiter.acquire()
+        # 스트리밍으로 받아 전체 디코딩을 기다리지 않고 부분 결과를 먼저 표시
+        response = await model.generate_content_async(prompt, stream=True)
+        parts = []
+        async for part in response:
+            parts.append(part.text)
+            if placeholder is not None:
+                placeholder.write("".join(parts))
+    return "".join(parts)
+
+async def summarize_with_gemini(prompt: str, mode: str, semaphore: asyncio.Semaphore, placeholder=None) -> str:
+    # 공백만 다른 프롬프트가 같은 키를 갖도록 정규화한 뒤 해시를 키로 사용.
+    # 지시문이 system_instruction으로 빠졌으므로 모드도 키에 포함해야 한다
+    key = f"gm:{mode}:" + hashlib.sha256(_WHITESPACE_RE.sub(" ", prompt).strip().encode()).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    model = get_gemini_model(PROMPT_PREFIX[mode])
+    text = await _generate_with_retry(model, prompt, semaphore, placeholder)
+    cache.set(key, text, expire=CACHE_TTL_SECONDS)
+    return text
+
+async def summarize_in_chunks(transcript: str, mode: str, status_container, semaphore: asyncio.Semaphore) -> str:
     chunks = chunk_text(transcript)
-    summaries = []
-    for i, chunk in enumerate(chunks):
-        status_container.info(f"[{mode}] 자막을 분석하는 중... ({i+1}/{len(chunks)})")
-        prompt = build_prompt(chunk, mode)
-        summary = summarize_with_gemini(prompt)
-        summaries.append(summary)
+    # 대부분의 자막은 한 구간에 들어가므로 통합(reduce) 호출 없이 바로 요약
+    if len(chunks) == 1:
+        status_container.info(f"[{mode}] 자막을 분석하는 중...")
+        placeholder = st.empty()
+        final_summary = await summarize_with_gemini(build_prompt(chunks[0]), mode, semaphore, placeholder)
+        placeholder.empty()  # 최종 결과는 아래에서 다시 출력
+        return final_summary
+    status_container.info(f"[{mode}] 자막을 {len(chunks)}개 구간으로 나누어 분석하는 중...")
+    # 구간별 요약은 서로 독립이므로 동시에 요청
+    tasks = [summarize_with_gemini(build_prompt(chunk), mode, semaphore) for chunk in chunks]
+    summaries = await asyncio.gather(*tasks)
     status_container.info(f"[{mode}] 최종 요약을 생성하는 중...")
-    final_prompt = f"다음은 영상 요약 조각들입니다. 이들을 하나의 요약으로 통합해줘.\n\n{'\n'.join(summaries)}"
-    return summarize_with_gemini(final_prompt)
+    joined_summaries = "\n".join(summaries)
+    final_prompt = f"다음은 영상 요약 조각들입니다. 이들을 하나의 요약으로 통합해줘.\n\n{joined_summaries}"
+    placeholder = st.empty()
+    final_summary = await summarize_with_gemini(final_prompt, mode, semaphore, placeholder)
+    placeholder.empty()  # 최종 결과는 아래에서 다시 출력
+    return final_summary
 
 # -----------------------------
 # Streamlit UI
@@ -125,6 +278,9 @@ if st.button("요약 시작") and url and selected_modes:
         status.empty()
         st.error("유효한 유튜브 링크를 입력해주세요.")
     else:
+        # 자막 다운로드와 Gemini 채널 워밍업은 서로 독립이므로 동시에 수행.
+        # 오류 메시지를 그릴 수 있는 자막 다운로드는 메인 스레드에 남는다
+        warmup_gemini_channel()
         transcript_data: Optional[list[dict]] = get_best_transcript(video_id)
 
         if not transcript_data:
@@ -132,16 +288,28 @@ if st.button("요약 시작") and url and selected_modes:
             st.error("이 영상은 자막이 없어 요약할 수 없습니다.")
         else:
             summaries_output = {}
-            for mode in selected_modes:
-                formatted_transcript: str = format_transcript_with_timestamps(transcript_data) if mode == "타임라인 요약" else " ".join([entry['text'] for entry in transcript_data])
+
+            # 모드마다 같은 문자열을 다시 만들지 않도록 포맷팅은 한 번만 수행
+            plain_transcript: str = " ".join([entry['text'] for entry in transcript_data])
+            timed_transcript: str = format_transcript_with_timestamps(transcript_data)
+
+            async def summarize_mode(mode: str, semaphore: asyncio.Semaphore) -> None:
+                formatted_transcript: str = timed_transcript if mode == "타임라인 요약" else plain_transcript
                 try:
-                    summary: str = summarize_in_chunks(formatted_transcript, mode, status)
+                    summary: str = await summarize_in_chunks(formatted_transcript, mode, status, semaphore)
                     summaries_output[mode] = summary
                 except Exception as e:
                     status.empty()
                     st.error(f"[{mode}] 요약 생성에 실패했습니다. 다시 시도해주세요.")
                     st.exception(e)
 
+            # 모드별 요약을 동시에 실행
+            async def run_summaries() -> None:
+                semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+                await asyncio.gather(*(summarize_mode(mode, semaphore) for mode in selected_modes))
+
+            run_async(run_summaries())
+
             status.empty()
             st.success("요약 완료!")
             for mode, summary in summaries_output.items():
@@ -2,9 +2,9 @@ import streamlit as st
 from google.cloud import speech
 from google.cloud import storage
 import google.generativeai as genai
-from pytube import YouTube
-import os
-import tempfile
+import re
+import shutil
+import subprocess
 from typing import Optional, List
 import logging
 
@@ -12,91 +12,125 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_VIDEO_ID_RE = re.compile(r"(?:v=|youtu\.be/|/embed/|/shorts/)([0-9A-Za-z_-]{11})")
+
+def extract_video_id(url: str) -> Optional[str]:
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+# 클라이언트 생성은 자격 증명 조회와 gRPC 채널 핸드셰이크를 동반하므로
+# 한 번만 만들어 재사용한다
+@st.cache_resource
+def get_speech_client() -> speech.SpeechClient:
+    return speech.SpeechClient()
+
+@st.cache_resource
+def get_storage_client() -> storage.Client:
+    return storage.Client()
+
 class VideoAnalyzer:
     def __init__(self):
-        self.speech_client = speech.SpeechClient()
-        self.storage_client = storage.Client()
+        self.speech_client = get_speech_client()
+        self.storage_client = get_storage_client()
+        self.bucket_name = st.secrets["GCS_BUCKET_NAME"]
         self.status = st.empty()
         
-    def download_audio(self, video_id: str) -> Optional[str]:
-        """YouTube 영상에서 오디오를 다운로드합니다."""
+    def stream_audio_to_gcs(self, video_id: str) -> Optional[str]:
+        """오디오를 내려받으면서 Opus로 변환해 곧바로 GCS에 업로드합니다.
+
+        yt-dlp -> ffmpeg -> GCS 업로드를 OS 파이프로 연결해 세 단계가
+        동시에 진행되며, 중간 파일은 디스크에 쓰지 않습니다.
+        """
+        downloader = None
+        transcoder = None
         try:
-            self.status.info("1. 영상에서 오디오를 추출하는 중...")
-            yt = YouTube(f"https://www.youtube.com/watch?v={video_id}")
-            audio_stream = yt.streams.filter(only_audio=True).first()
-            
-            # 임시 파일로 저장
-            with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_file:
-                audio_path = temp_file.name
-                audio_stream.download(filename=audio_path)
-                
-            self.status.info("2. 오디오 추출 완료!")
-            return audio_path
-            
+            self.status.info("1. 오디오를 추출해 GCS로 스트리밍하는 중...")
+
+            # yt-dlp가 병렬(range) 다운로드한 스트림을 ffmpeg가 Opus 24kbps로
+            # 변환해 stdout으로 내보내고, 업로드가 그 파이프를 바로 소비한다
+            downloader = subprocess.Popen(
+                ["yt-dlp", "-N", "8", "-f", "bestaudio", "-o", "-", "--quiet",
+                 f"https://www.youtube.com/watch?v={video_id}"],
+                stdout=subprocess.PIPE,
+            )
+            transcoder = subprocess.Popen(
+                ["ffmpeg", "-i", "-",
+                 "-c:a", "libopus", "-b:a", "24k", "-ar", "16000",
+                 "-f", "ogg", "-"],
+                stdin=downloader.stdout, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            downloader.stdout.close()  # 파이프는 transcoder만 소유
+
+            blob = self.storage_client.bucket(self.bucket_name).blob(f"audio/{video_id}.ogg")
+            blob.chunk_size = 8 * 1024 * 1024  # 재시도 가능한 청크 단위 업로드
+            # 파이프는 seek이 불가능해 upload_from_file의 재개형 업로드가
+            # 실패하므로, BlobWriter를 통해 청크 단위로 흘려보낸다
+            with blob.open("wb", content_type="audio/ogg") as writer:
+                shutil.copyfileobj(transcoder.stdout, writer, length=1024 * 1024)
+
+            if transcoder.wait() != 0 or downloader.wait() != 0:
+                raise RuntimeError("오디오 다운로드/변환 실패")
+
+            self.status.info("2. 오디오 업로드 완료!")
+            return f"gs://{self.bucket_name}/{blob.name}"
+
         except Exception as e:
-            logger.error(f"오디오 다운로드 실패: {str(e)}")
+            logger.error(f"오디오 스트리밍 실패: {str(e)}")
             self.status.error(f"오디오 추출 실패: {str(e)}")
+            # 실패 시 파이프라인에 남은 자식 프로세스를 정리한다
+            for proc in (transcoder, downloader):
+                if proc is not None and proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
             return None
-            
-    def transcribe_audio(self, audio_path: str) -> Optional[str]:
-        """오디오 파일을 텍스트로 변환합니다."""
+
+    def transcribe_audio(self, gcs_uri: str) -> Optional[str]:
+        """GCS에 업로드된 오디오를 텍스트로 변환합니다."""
         try:
             self.status.info("3. 음성을 텍스트로 변환하는 중...")
-            
-            # 오디오 파일 읽기
-            with open(audio_path, "rb") as audio_file:
-                content = audio_file.read()
-                
-            # 오디오 설정
-            audio = speech.RecognitionAudio(content=content)
+
+            # URI 입력이므로 파일 전체를 메모리에 올리지 않고, 인라인 10MB 제한도 없음
+            audio = speech.RecognitionAudio(uri=gcs_uri)
             config = speech.RecognitionConfig(
-                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+                encoding=speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
                 sample_rate_hertz=16000,
                 language_code="ko-KR",  # 한국어 우선
                 enable_automatic_punctuation=True,
             )
-            
+
             # 음성 인식 요청
             operation = self.speech_client.long_running_recognize(
                 config=config, audio=audio
             )
-            
+
             self.status.info("4. 음성 인식 중... (잠시만 기다려주세요)")
-            response = operation.result(timeout=90)
-            
+            # URI 입력은 1분 이상의 긴 오디오가 전제이므로 클라이언트 쪽
+            # 타임아웃 없이 작업이 끝날 때까지 폴링한다
+            response = operation.result()
+
             # 결과 처리
             transcript = ""
             for result in response.results:
                 transcript += result.alternatives[0].transcript + "\n"
-                
+
             self.status.info("5. 음성 인식 완료!")
             return transcript
-            
+
         except Exception as e:
             logger.error(f"음성 인식 실패: {str(e)}")
             self.status.error(f"음성 인식 실패: {str(e)}")
             return None
-            
-        finally:
-            # 임시 파일 삭제
-            try:
-                os.unlink(audio_path)
-            except:
-                pass
-                
+
     def analyze_video(self, video_id: str) -> Optional[str]:
         """영상을 분석하여 텍스트로 변환합니다."""
-        # 오디오 다운로드
-        audio_path = self.download_audio(video_id)
-        if not audio_path:
+        # 다운로드·변환·업로드가 파이프로 동시에 진행된다
+        gcs_uri = self.stream_audio_to_gcs(video_id)
+        if not gcs_uri:
             return None
-            
+
         # 음성 인식
-        transcript = self.transcribe_audio(audio_path)
-        if not transcript:
-            return None
-            
-        return transcript
+        return self.transcribe_audio(gcs_uri)
 
 def main():
     st.set_page_config(page_title="유튜브 영상 분석기", page_icon="🎥")
@@ -107,13 +141,8 @@ def main():
     
     if st.button("분석 시작") and url:
         # 비디오 ID 추출
-        video_id = None
-        if "youtube.com" in url or "youtu.be" in url:
-            if "v=" in url:
-                video_id = url.split("v=")[1].split("&")[0]
-            else:
-                video_id = url.split("/")[-1]
-                
+        video_id = extract_video_id(url)
+
         if not video_id:
             st.error("유효한 유튜브 링크를 입력해주세요.")
             return